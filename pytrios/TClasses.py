@@ -10,21 +10,44 @@ from TClasses import TProtocolError, TPacket, TChannel
 @author: Stefan Simis
 """
 
-import sys
 import datetime
+import functools
+import logging
 import struct
+import threading
+import time
 import serial
 import numpy as np
 from serial import Serial
 
+log = logging.getLogger('pt1')
+
 # global definitions
 TIMEOUT_SAM = 12
 TIMEOUT_MF = 5
+# module types handled as SAM spectroradiometers
+SAM_TYPES = frozenset(('SAM', 'SAMIP'))
+
+# packet layout: 6 header bytes, databytes, checkbyte. Valid sizes are 2..128
+DATA_OFFSET = 6
+_HEADER_STRUCT = struct.Struct('<6B')
+# MicroFlu ROM config payload: IntAvg, flags, big endian offsets, scales
+_MFCFG_STRUCT = struct.Struct('>3xBBHHBBBB')
+# two-digit hex strings for each byte value, used to build TIDs
+_HEX2 = ['%02x' % i for i in range(256)]
+# module type from the 5 most significant bits of the serial number
+_MODULE_TYPES = {2: 'MicroFlu', 4: 'IOM', 8: 'COM', 9: 'IPS', 10: 'SAMIP',
+                 12: 'SCM', 16: 'SAM', 17: 'SAM', 20: 'DFM', 24: 'ADM'}
+# operating frequency in MHz by query byte
+_MODULE_FREQS = (np.nan, 2, 4, 6, 8, 10, 12, 20)
 
 
 class TSerial(Serial):
-    def __init__(self, port, timeout=0.01, baudrate=9600, xonxoff=True,
-                 parity='N', stopbits=1, bytesize=8):#, verbosity=1):
+    def __init__(self, port, timeout=0.1, baudrate=9600, xonxoff=True,
+                 parity='N', stopbits=1, bytesize=8,
+                 low_latency=False, write_timeout=1.0):#, verbosity=1):
+        # commands are sent from the parser thread as well as by callers
+        self.write_lock = threading.Lock()
         try:
             port = str(port)
             #port = "/dev/ttyUSB"+port.strip('/dev/ttyUSB')  # be less presprictively unix
@@ -35,13 +58,24 @@ class TSerial(Serial):
             self.parity = parity
             self.stopbits = stopbits
             self.bytesize = bytesize
+            self.write_timeout = write_timeout  # error out on a stuck port
             #self.verbosity = verbosity
+            if low_latency:
+                set_low_latency(self, True)
         except Exception:
-            print("Error connecting to port {0}\n".format(self.port),
-                  file=sys.stderr)
+            log.error("Error connecting to port %s", self.port)
             return None
 
 
+def set_low_latency(ser, state=True):
+    """Toggle ASYNC_LOW_LATENCY on the driver of serial port *ser* (Linux
+    only), which stops USB-serial adapters holding back small reads"""
+    try:
+        ser.set_low_latency_mode(state)
+    except (AttributeError, IOError, ValueError):
+        log.warning("Low latency mode not supported on %s", ser.port)
+
+
 class TProtocolError(Exception):
     def __init__(self, value):
         self.value = value
@@ -60,51 +94,75 @@ class TPackMeasKeyError(Exception):
 
 class TPacket(object):
     """TrioS sensor data package object"""
-    def __init__(self, s2parse=None):
+    __slots__ = ('packetType', 'timeStampPC', 'timeStampPerf', '_buf', 'id1',
+                 'id1_databytes', 'id1_fut', 'id1_id', 'id2', 'moduleID', 'moduleID_zipped',
+                 'moduleID_I2Cadd', 'framebyte', 'time1', 'time2',
+                 'databytes', 'checkbyte', 'tid1', 'tid2', 'tid3', 'TID',
+                 'tchannel', 'microFluConfig')
+    # set from the block header, left unset by a block of the wrong size
+    _HEADER = ('id2', 'moduleID', 'moduleID_zipped', 'moduleID_I2Cadd',
+               'framebyte', 'time1', 'time2', 'databytes', 'checkbyte',
+               'tid1', 'tid2', 'tid3', 'TID')
+
+    def __init__(self, s2parse=None, timeStampPC=None, timeStampPerf=None):
+        # only set for some packet types
         self.packetType = None
+        self.tchannel = None
+        self.microFluConfig = None
         if s2parse is None:
+            self._clear(TPacket.__slots__)
             return
-        self.timeStampPC = datetime.datetime.now()  # time of parsing
+        if timeStampPC is None:
+            timeStampPC = datetime.datetime.now()  # time of parsing
+        if timeStampPerf is None:
+            timeStampPerf = time.perf_counter()
+        self.timeStampPC = timeStampPC
+        self.timeStampPerf = timeStampPerf  # perf_counter() equivalent
+        # raw block, payload interpreters unpack from here at DATA_OFFSET
+        self._buf = s2parse
         # identity byte 1
-        self.id1 = s2parse[0]
+        b0 = s2parse[0]
+        self.id1 = b0
         # 3 msb give size of data frame
-        self.id1_databytes = 2*2**(s2parse[0] >> 5)
+        self.id1_databytes = 2 << (b0 >> 5)
         # 5th bit is for future compatibility
-        self.id1_fut = (s2parse[0] & 0b10000) >> 4
+        self.id1_fut = (b0 & 0b10000) >> 4
         # first 4 lsb are identity bits
-        self.id1_id = s2parse[0] & 0b1111
+        self.id1_id = b0 & 0b1111
         # error defined in TriOS protocol
         if self.id1_databytes == 256:
-            print("TPacket init: Blocksize invalid", file=sys.stderr)
+            log.error("TPacket init: Blocksize invalid")
+            self._clear(TPacket._HEADER)
             return
-        formatstring = '<BBBBBB'+str(self.id1_databytes)+'BB'
-        try:
-            Data = struct.unpack(formatstring, s2parse)
-        except:
-            prettyhex = ":".join("{0:x}".format(c) for c in s2parse)
-            print("TPacket init: cannot unpack block:\n\t{0}"
-                  .format(prettyhex), file=sys.stderr)
+        n = self.id1_databytes
+        if len(s2parse) != DATA_OFFSET + n + 1:
+            log.error("TPacket init: cannot unpack block:\n\t%s",
+                      s2parse.hex(':'))
+            self._clear(TPacket._HEADER)
             return
+        _, id2, moduleID, framebyte, time1, time2 = \
+            _HEADER_STRUCT.unpack_from(s2parse)
         # interpret framebyte and databytes
         # identity byte 2
-        self.id2 = Data[1]
+        self.id2 = id2
         # module ID byte
-        self.moduleID = Data[2]
+        self.moduleID = moduleID
         # zipped data if 1, original data if 0
-        self.moduleID_zipped = Data[2] & 0b1
+        self.moduleID_zipped = moduleID & 0b1
         # Module I2C address in 7 msb
-        self.moduleID_I2Cadd = Data[2] >> 1
+        self.moduleID_I2Cadd = moduleID >> 1
         # Framebyte, 0=single or last frame, 255=module info, 254=error message
-        self.framebyte = Data[3]
+        self.framebyte = framebyte
         # 0 = no realtime clock
-        self.time1 = Data[4]
+        self.time1 = time1
         # 0 = no realtime clock
-        self.time2 = Data[5]
-        self.databytes = Data[6:6+self.id1_databytes]
-        self.checkbyte = Data[-1]  # not used
-        self.tid1 = hex(self.id1_id)[2:].zfill(2)
-        self.tid2 = hex(self.id2)[2:].zfill(2)
-        self.tid3 = hex(self.moduleID)[2:].zfill(2)
+        self.time2 = time2
+        # zero-copy view on the payload, indexing gives ints like a tuple
+        self.databytes = memoryview(s2parse)[DATA_OFFSET:DATA_OFFSET+n]
+        self.checkbyte = s2parse[DATA_OFFSET+n]  # not used
+        self.tid1 = _HEX2[self.id1_id]
+        self.tid2 = _HEX2[self.id2]
+        self.tid3 = _HEX2[self.moduleID]
         self.TID = self.tid1 + self.tid2 + self.tid3
 
         # PacketType
@@ -112,43 +170,42 @@ class TPacket(object):
             # sensor reports error
             self.packetType = 'error'
             emsg = "TSerial_parse: Instrument reports error, wrong command?"
-            prettyhex = ":".join("{0:x}".format(c) for c in s2parse)
-            print("{0}\n\t{1}".format(emsg, prettyhex), file=sys.stderr)
+            log.error("%s\n\t%s", emsg, s2parse.hex(':'))
             return
 
         elif self.moduleID == 164:
             # MicroFlu configuration package (address A4)
             self.packetType = 'mfconfig'
-            self.microFluConfig = self.MFluConfInterp(self)
+            self.microFluConfig = self.MFluConfInterp()
 
         elif self.framebyte == 255:
             self.packetType = 'query'
             self.tchannel = self.QInterp()
             if self.tchannel.TInfo.ModuleType == 'MicroFlu':
                 self.MFluReadSettings()
-            elif self.tchannel.TInfo.ModuleType in['SAM', 'SAMIP']:
+            elif self.tchannel.TInfo.ModuleType in SAM_TYPES:
                 self.SAMReadSettings()
 
         elif self.framebyte < 254:
             self.packetType = 'measurement'
 
+    def _clear(self, names):
+        for name in names:
+            setattr(self, name, None)
+
     def QInterp(self):
         tchannel = TChannel()
         serlow = self.databytes[0]  # last 2 hex chars of SN
         serhi = self.databytes[1]  # first 2 hex chars of SN
-        vals = [2, 4, 8, 9, 10, 12, 16, 17, 20, 24]
-        types = ['MicroFlu', 'IOM', 'COM', 'IPS',
-                 'SAMIP', 'SCM', 'SAM', 'SAM', 'DFM', 'ADM']
         tchannel.TInfo.TID = self.TID
-        tchannel.TInfo.serialn = str.upper(f"{serhi:02x}{serlow:02x}")
+        tchannel.TInfo.serialn = (_HEX2[serhi] + _HEX2[serlow]).upper()
 
         # module type from 5 most sign Bits
-        tchannel.TInfo.ModuleType = types[vals.index(serhi >> 3)]
+        tchannel.TInfo.ModuleType = _MODULE_TYPES[serhi >> 3]
         tchannel.TInfo.Firmware = self.databytes[3] +\
             0.01 * self.databytes[2]
         # operating freq. in MHz
-        freqs = [np.nan, 2, 4, 6, 8, 10, 12, 20]
-        tchannel.TInfo.ModFreq = freqs[self.databytes[4]]
+        tchannel.TInfo.ModFreq = _MODULE_FREQS[self.databytes[4]]
         return tchannel
 
     def MFluReadSettings(self):
@@ -179,19 +236,17 @@ class TPacket(object):
     def MFluConfInterp(self):
         "read MicroFlu configuration (not part of query request)"
         mfcfg = MFROMConfig()
-        mfcfg.IntAvg = self.databytes[3]
+        (mfcfg.IntAvg, flags, hioff, looff,
+         hiscale, hifrac, loscale, lofrac) = \
+            _MFCFG_STRUCT.unpack_from(self._buf, DATA_OFFSET)
         # 1 is Start measuring on startup
-        mfcfg.Auto = (self.databytes[4] & 0b00001000) >> 3
+        mfcfg.Auto = (flags & 0b00001000) >> 3
         # 0/1/2 = high/auto/low
-        mfcfg.Ampl = self.databytes[4] >> 4
-        mfcfg.HighA_Offset = np.float(self.databytes[5] * 256 +
-                                      self.databytes[6])
-        mfcfg.LowA_Offset = np.float(self.databytes[7] * 256 +
-                                     self.databytes[8])
-        mfcfg.HighA_Scale = np.float(self.databytes[9])\
-            + np.float(self.databytes[10]) / 256
-        mfcfg.LowA_Scale = np.float(self.Databytes[11])\
-            + np.float(self.databytes[12]) / 256
+        mfcfg.Ampl = flags >> 4
+        mfcfg.HighA_Offset = float(hioff)
+        mfcfg.LowA_Offset = float(looff)
+        mfcfg.HighA_Scale = hiscale + hifrac / 256.0
+        mfcfg.LowA_Scale = loscale + lofrac / 256.0
         return mfcfg
 
     def __repr__(self):
@@ -202,21 +257,28 @@ class TPacket(object):
 
 
 class SAMSettings(object):
+    __slots__ = ('SAMConfiguration', 'SAMRange', 'SAMStatus')
+
     def __init__(self, SAMConfiguration=None, SAMRange=None,
                  SAMStatus=None):
-        pass
+        self.SAMConfiguration = SAMConfiguration
+        self.SAMRange = SAMRange
+        self.SAMStatus = SAMStatus
 
 
 class TSAM(object):
     """Represents a SAM instrument:\n
     *Settings* = Sensor specific settings\n
-    *lastRawSAM* = last uncalibrated spectrum from SAM unit\n
-    *lastRawSAMTime* = Reception timestamp of last spectrum\n"""
-    def __init__(self, Settings=SAMSettings, dataframes=[[None]]*8,
+    *lastRawSAM* = last uncalibrated spectrum from SAM unit (uint16 array)\n
+    *lastRawSAMTime* = Reception timestamp of last spectrum\n
+    *lastRawSAMTime_pc* = time.perf_counter() at reception, for delays\n"""
+    def __init__(self, Settings=SAMSettings,
                  lastRawSAM=None, lastRawSAMTime=None, lastIntTime=None):
         self.Settings = Settings()
-        self.dataframes = dataframes
+        self._spectrum = None  # spectrum being assembled from dataframes
+        self._frames = 0  # bitmask of dataframes received
         self.lastRawSAMTime = lastRawSAMTime
+        self.lastRawSAMTime_pc = None
         self.lastRawSAM = lastRawSAM
         self.lastIntTime = lastIntTime
 
@@ -232,6 +294,8 @@ class TInfo(object):
     *ModuleType* = SAM, SAMIP, MicroFlu\n
     *Firmware* = Sensor firmware\n
     *ModFreq* = Sensor internal frequency\n"""
+    __slots__ = ('TID', 'ModuleType', 'Firmware', 'ModFreq', 'serialn')
+
     def __init__(self, TID=None, ModuleType=None, Firmware=None,
                  ModFreq=None, serialn=None):
         self.TID = TID
@@ -250,23 +314,41 @@ class TInfo(object):
 class MFSettings(object):
     """Microflu sensor specific settings\n
     *Ftype*:     1/2/3/4/5 = Chl, blue, CDOM, unkonwn, Red\n
-    *Mit*: internal averaging\n
+    *SMit*: internal averaging\n
     *CtlStart*: sensor is active\n*CtlAnalog*:analog output on\n
     *CtlRange*: 0/1 = high/low gain\n
     *CtlAutoR*: 1/0 = Auto-range On/Off\n
     *CtlContn*: 0/1 = On Demand / Continuous\n"""
+    __slots__ = ('Ftype', 'SMit', 'CtlStart', 'CtlAnalog', 'CtlRange',
+                 'CtlAutoR', 'CtlContn')
+
     def __init__(self, Ftype=None, SMit=None,
                  CtlStart=None, CtlAnalog=None, CtlRange=None,
                  CtlAutoR=None, CtlContn=None):
-        pass
+        self.Ftype = Ftype
+        self.SMit = SMit
+        self.CtlStart = CtlStart
+        self.CtlAnalog = CtlAnalog
+        self.CtlRange = CtlRange
+        self.CtlAutoR = CtlAutoR
+        self.CtlContn = CtlContn
 
 
 class MFROMConfig(object):
     "IntAvg, Auto, Ampl, HighA_Offset, LowA_Offset, HighA_Scale, LowA_Scale"
+    __slots__ = ('IntAvg', 'Auto', 'Ampl', 'HighA_Offset', 'LowA_Offset',
+                 'HighA_Scale', 'LowA_Scale')
+
     def __init__(self, IntAvg=None, Auto=None, Ampl=None,
                  HighA_Offset=None, LowA_Offset=None,
                  HighA_Scale=None, LowA_Scale=None):
-        pass
+        self.IntAvg = IntAvg
+        self.Auto = Auto
+        self.Ampl = Ampl
+        self.HighA_Offset = HighA_Offset
+        self.LowA_Offset = LowA_Offset
+        self.HighA_Scale = HighA_Scale
+        self.LowA_Scale = LowA_Scale
 
 
 class TMicroFlu(object):
@@ -290,13 +372,13 @@ class TMicroFlu(object):
             msg = "<PyTrios MicroFlu-{0}, Averaging={1}, \
                 Continuous={2}, Autorange={3}, \
                 last measurement={4}: {5}>".format(ftypes[self.Settings.Ftype],
-                                                   self.Settings.Mit,
+                                                   self.Settings.SMit,
                                                    self.Settings.CtlContn,
                                                    self.Settings.CtlAutoR,
                                                    self.lastFluTime,
                                                    self.lastFluCal)
             return msg
-        except:
+        except (IndexError, TypeError):
             return str(None)
 
 
@@ -311,6 +393,9 @@ class TChannel(object):
         self.serial = None  # recursively link ser object when query received
         self.lasttrigger = None
         self.lastcommand = 'query'
+        # set by the interpreters when a measurement arrives after the
+        # last trigger, wait on it rather than polling is_finished
+        self.measured = threading.Event()
 
     def is_pending(self):
         '''check whether new measurement is pending (False if timed out)'''
@@ -319,7 +404,7 @@ class TChannel(object):
                 or (self.is_finished()):
             return False
         elapsed = datetime.datetime.now() - self.lasttrigger
-        if self.TInfo.ModuleType in ['SAM', 'SAMIP']:
+        if self.TInfo.ModuleType in SAM_TYPES:
             return elapsed.total_seconds() < TIMEOUT_SAM
         elif self.TInfo.ModuleType == 'MicroFlu':
             return elapsed.total_seconds() < TIMEOUT_MF
@@ -329,7 +414,7 @@ class TChannel(object):
         lastmeas = None
         if self.lastcommand != 'measurement' or self.lasttrigger is None:
             return False
-        if self.TInfo.ModuleType in ['SAM', 'SAMIP']:
+        if self.TInfo.ModuleType in SAM_TYPES:
             lastmeas = self.TSAM.lastRawSAMTime
         elif self.TInfo.ModuleType == 'MicroFlu':
             lastmeas = self.TMicroFlu.lastFluTime
@@ -337,49 +422,65 @@ class TChannel(object):
             return lastmeas > self.lasttrigger
 
     def _send_command(self, ser, command, par='00'):
-        if self.TInfo.ModuleType in ['SAM', 'SAMIP']:
+        if self.TInfo.ModuleType in SAM_TYPES:
             commandset = 'SAM'
         elif self.TInfo.ModuleType == 'MicroFlu':
             commandset = 'MicroFlu'
         else:
             if self.verbosity >= 1:
-                print("command not imnplemented for moduletype {0}"
-                      .format(self.TInfo.ModuleType), file=sys.stderr)
+                log.error("command not implemented for moduletype %s",
+                          self.TInfo.ModuleType)
             return
         ipschan = self.TInfo.TID[0:2]
         TCommandSend(ser, commandset, command, ipschan, par1=par)
 
-    def query(self, ser, trigger=datetime.datetime.now()):
+    def query(self, ser, trigger=None):
         self.lastcommand = 'query'
+        if trigger is None:
+            trigger = datetime.datetime.now()
         self.lasttrigger = trigger
         self._send_command(ser, command='query')
 
-    def startIntAuto(self, ser, trigger=datetime.datetime.now()):
-        if self.TInfo.ModuleType not in ['SAM', 'SAMIP']:
+    def startIntAuto(self, ser, trigger=None):
+        if self.TInfo.ModuleType not in SAM_TYPES:
             if self.verbosity >= 1:
-                print("tchannel: startIntAuto not implemented for {0}"
-                      .format(self.TInfo.ModuleType), file=sys.stderr)
+                log.error("tchannel: startIntAuto not implemented for %s",
+                          self.TInfo.ModuleType)
             return
         self.lastcommand = 'measurement'
+        if trigger is None:
+            trigger = datetime.datetime.now()
         self.lasttrigger = trigger
+        self.measured.clear()
         self._send_command(ser, command='startIntAuto', par='00')
 
-    def startIntSet(self, ser, inttime, trigger=datetime.datetime.now()):
+    def startIntSet(self, ser, inttime, trigger=None):
         """ *inttime in ms to be one of
         0 (autorange), 8 , 16 32 64 128 256 512 1024 2048 4096 8192
         """
-        if self.TInfo.ModuleType not in ['SAM', 'SAMIP']:
+        frame = self.startIntSetFrame(inttime, trigger)
+        if frame is not None:
+            TCommandSendBatch(ser, [frame])
+
+    def startIntSetFrame(self, inttime, trigger=None):
+        """As startIntSet, but return the command bytes rather than sending
+        them, so triggers for several channels can go out together with
+        TCommandSendBatch. Returns None if the module is not a SAM"""
+        if self.TInfo.ModuleType not in SAM_TYPES:
             if self.verbosity >= 1:
-                print("tchannel: startIntSet not implemented for {0}"
-                      .format(self.TInfo.ModuleType), file=sys.stderr)
-            return
+                log.error("tchannel: startIntSet not implemented for %s",
+                          self.TInfo.ModuleType)
+            return None
         inttimes = {0: '00', 8: '02', 16: '03', 32: '04', 64: '05',
                     128: '06', 256: '07', 512: '08', 1024: '09',
                     2048: '0A', 4096: '0B', 8192: '0C'}
         par = inttimes[inttime]
         self.lastcommand = 'measurement'
+        if trigger is None:
+            trigger = datetime.datetime.now()
         self.lasttrigger = trigger
-        self._send_command(ser, command='startIntSet', par=par)
+        self.measured.clear()
+        return TCommandFrame('SAM', 'startIntSet', self.TInfo.TID[0:2], par)
 
     def __repr__(self):
         try:
@@ -389,11 +490,76 @@ class TChannel(object):
                         self.TInfo.serialn,
                         hex(id(self)))
             return msg
-        except Exception as e:
-            print(e)  # debug
+        except Exception:
             return "<PyTrios channel (no info)>"
 
 
+# Command frames are 8 bytes: 23 [ipschan] 00 [address] [command..] 01.
+# Tables hold each command with the IPS channel zeroed, plus the offset of
+# the user parameter (par1) if the command takes one.
+# SAM address = 80
+# SAMIP address = 80 but 20 for IP and 30 for SAM commands
+_COMMANDS = {
+    None: {
+        'query': (bytes.fromhex("23 00 00 80 B0 00 00 01"), None)},
+    'MicroFlu': {
+        'ReadCfg': (bytes.fromhex("23 00 00 00 c0 00 00 01"
+                                  "23 00 00 00 08 00 03 01"
+                                  "23 00 00 00 08 00 04 01"
+                                  "23 00 00 00 a0 a4 10 01"), None),
+        'cont_on': (bytes.fromhex("23 00 00 00 78 0f 01 01"), None),
+        'cont_off': (bytes.fromhex("23 00 00 00 78 0f 00 01"), None),
+        'query': (bytes.fromhex("23 00 00 00 B0 00 00 01"), None),
+        'start': (bytes.fromhex("23 00 00 00 A8 00 81 01"), None),
+        'stop': (bytes.fromhex("23 00 00 00 A8 00 82 01"), None),
+        'autoamp_on': (bytes.fromhex("23 00 00 00 78 06 01 01"), None),
+        'autoamp_off': (bytes.fromhex("23 00 00 00 78 06 00 01"), None),
+        'lowamp_on': (bytes.fromhex("23 00 00 00 78 05 01 01"), None),
+        'lowamp_off': (bytes.fromhex("23 00 00 00 78 05 00 01"), None),
+        'int_avg': (bytes.fromhex("23 00 00 00 78 04 00 01"), 6)},
+    'SAM': {
+        'startIntAuto': (bytes.fromhex("23 00 00 30 78 05 00 01"
+                                       "23 00 00 80 A8 00 81 01"), None),
+        'startIntSet': (bytes.fromhex("23 00 00 30 78 05 00 01"
+                                      "23 00 00 80 A8 00 81 01"), 6),
+        'cont_mode_off': (bytes.fromhex("23 00 00 30 78 F0 02 01"), None),
+        'cont_mode_on': (bytes.fromhex("23 00 00 30 78 F0 03 01"), None),
+        'setIntTime': (bytes.fromhex("23 00 00 30 78 05 00 01"), 6),
+        'sleep': (bytes.fromhex("23 00 00 80 A0 00 00 01"), None),
+        'setbaud': (bytes.fromhex("23 00 00 30 50 01 00 01"), 6),
+        'fastauto': (bytes.fromhex("23 00 00 30 50 01 0C 01"
+                                   "23 00 00 30 78 F0 03 01"), None),
+        'query_sam': (bytes.fromhex("23 00 00 30 B0 00 00 01"), None)}}
+
+"""
+Note baudrate changes did not function with an IPS box. Test further.
+valid (hex) par1 values for setbaud:
+2 400 baud: par = CF
+4 800 baud: par = 67
+9 600 baud: par = 33
+19 200 baud: par = 19
+38 400 baud: par = 0C
+(57 600 baud: par = 08, only at 8MHz)
+
+valid (hex) pars for inttime (startIntSet, setIntTime):
+00: autorange
+02 8ms, 03 16ms, 04 32ms, 05 64ms, 06 128ms, 07 256ms
+08 512ms, 09 1024ms, 0A 2048ms, 0B 4096ms, 0C 8192ms
+"""
+
+
+@functools.lru_cache(maxsize=256)
+def TCommandFrame(commandset, command='query', ipschan='00', par1='00'):
+    """Return the bytes for a command, see TCommandSend for arguments.
+    Frames are cached, there are only a few channel/parameter combinations"""
+    template, parpos = _COMMANDS[commandset][command]
+    frame = bytearray(template)
+    frame[1::8] = bytes([int(ipschan, 16)]) * (len(frame) // 8)
+    if parpos is not None:
+        frame[parpos] = int(par1, 16)
+    return bytes(frame)
+
+
 def TCommandSend(ser, commandset, command='query', ipschan='00', par1='00'):
     """Send command to a TriOS device.\n
     Device configuration commands are not supported.\n
@@ -415,100 +581,33 @@ def TCommandSend(ser, commandset, command='query', ipschan='00', par1='00'):
     the documentation, even when listed as parameter2 in the docs.
     Most commands require at most one argument.\n\n
     """
-    commandsetdict = {None: 0, 'MicroFlu': 1, 'SAM': 2}
-    commanddict = ['']*len(commandsetdict)
-    commanddict[0] = {'query': bytearray.fromhex("23 "
-                      + str(ipschan) + " 00 80 B0 00 00 01")}
-    commanddict[1] = {
-        'ReadCfg': bytearray.fromhex("23 " + str(ipschan)
-                                     + " 00 00 c0 00 00 01 23 " + ipschan
-                                     + " 00 00 08 00 03 01 23 " + ipschan
-                                     + " 00 00 08 00 04 01 23 " + ipschan
-                                     + " 00 00 a0 a4 10 01"),
-        'cont_on': bytearray.fromhex("23 " + str(ipschan)
-                                     + " 00 00 78 0f 01 01"),
-        'cont_off': bytearray.fromhex("23 " + str(ipschan)
-                                      + " 00 00 78 0f 00 01"),
-        'query': bytearray.fromhex("23 " + str(ipschan)
-                                   + " 00 00 B0 00 00 01"),
-        'start': bytearray.fromhex("23 " + str(ipschan)
-                                   + " 00 00 A8 00 81 01"),
-        'stop': bytearray.fromhex("23 " + str(ipschan)
-                                  + " 00 00 A8 00 82 01"),
-        'autoamp_on': bytearray.fromhex("23 " + str(ipschan)
-                                        + " 00 00 78 06 01 01"),
-        'autoamp_off': bytearray.fromhex("23 " + str(ipschan)
-                                         + " 00 00 78 06 00 01"),
-        'lowamp_on': bytearray.fromhex("23 " + str(ipschan)
-                                       + " 00 00 78 05 01 01"),
-        'lowamp_off': bytearray.fromhex("23 " + str(ipschan)
-                                        + " 00 00 78 05 00 01"),
-        'int_avg': bytearray.fromhex("23 " + str(ipschan)
-                                     + " 00 00 78 04 " + str(par1) + " 01")}
-
-    # SAM address = 80
-    # SAMIP address = 80 but 20 for IP and 30 for SAM commands
-    commanddict[2] = {
-        'startIntAuto': bytearray.fromhex("23 " + str(ipschan)
-                                          + " 00 30 78 05 00 01 23 "
-                                          + str(ipschan)
-                                          + " 00 80 A8 00 81 01"),
-        # valid par1 values for startIntset:
-        'startIntSet': bytearray.fromhex("23 " + str(ipschan)
-                                         + " 00 30 78 05 " + str(par1)
-                                         + " 01 23 " + str(ipschan)
-                                         + " 00 80 A8 00 81 01"),
-        'cont_mode_off': bytearray.fromhex("23 " + str(ipschan)
-                                           + " 00 30 78 F0 02 01"),
-        'cont_mode_on': bytearray.fromhex("23 " + str(ipschan)
-                                          + " 00 30 78 F0 03 01"),
-        'setIntTime': bytearray.fromhex("23 " + str(ipschan)
-                                        + " 00 30 78 05 "+str(par1)+" 01"),
-        'sleep': bytearray.fromhex("23 " + str(ipschan)
-                                   + " 00 80 A0 00 00 01"),
-        'setbaud': bytearray.fromhex("23 " + str(ipschan)
-                                     + " 00 30 50 01 "+str(par1)+" 01"),
-        'fastauto': bytearray.fromhex("23 " + str(ipschan)
-                                      + " 00 30 50 01 0C 01 23 " + str(ipschan)
-                                      + " 00 30 78 F0 03 01"),
-        'query_sam': bytearray.fromhex("23 " + str(ipschan)
-                                       + " 00 30 B0 00 00 01")}
-
-    """
-    Note baudrate changes did not function with an IPS box. Test further.
-    valid (hex) par1 values for setbaud:
-    2 400 baud: par = CF
-    4 800 baud: par = 67
-    9 600 baud: par = 33
-    19 200 baud: par = 19
-    38 400 baud: par = 0C
-    (57 600 baud: par = 08, only at 8MHz)
-
-    valid (hex) pars for inttime:
-    00: autorange
-    02 8ms, 03 16ms, 04 32ms, 05 64ms, 06 128ms, 07 256ms
-    08 512ms, 09 1024ms, 0A 2048ms, 0B 4096ms, 0C 8192ms
-    """
-
-    commandhex = commanddict[commandsetdict[commandset]][command]
     try:
-        if ser.out_waiting > 0:
-            ser.flush()
-        ser.write(commandhex)
+        commandhex = TCommandFrame(commandset, command, ipschan, par1)
+        with ser.write_lock:
+            ser.write(commandhex)  # multi-frame commands go out in one write
         if ser.verbosity >= 3:
-            print("{0} written to {1} ({2})".format(command,
-                                                    ser.port,
-                                                    ipschan), file=sys.stdout)
+            log.debug("%s written to %s (%s)", command, ser.port, ipschan)
     except serial.SerialException as e:
-        print(e.message, file=sys.stderr)
-        pass
+        log.error("TCommandSend: %s", e)
     except KeyError:
         if ser.verbosity >= 1:
-            emsg = "TCommandSend: Command or command set not recognized"
-            print(emsg, file=sys.stderr)
-        pass
+            log.error("TCommandSend: Command or command set not recognized")
     except Exception:
         if ser.verbosity >= 1:
-            emsg = "TCommandSend: Unidentified error, please check format"
-            print(emsg, file=sys.stderr)
-        pass
+            log.error("TCommandSend: Unidentified error, please check format")
+
+
+def TCommandSendBatch(ser, frames):
+    """Send several command frames (from TCommandFrame) in a single write,
+    e.g. to trigger all sensors on a port at once. None frames (unsupported
+    command or setting) are skipped"""
+    frames = [f for f in frames if f is not None]
+    if not frames:
+        return
+    try:
+        with ser.write_lock:
+            ser.write(b''.join(frames))
+        if ser.verbosity >= 3:
+            log.debug("%s commands written to %s", len(frames), ser.port)
+    except serial.SerialException as e:
+        log.error("TCommandSendBatch: %s", e)
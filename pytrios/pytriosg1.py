@@ -23,15 +23,31 @@ Note: PyTrios uses the *serial* module by Chris Liechti
 Last update: see __version__
 """
 
-import sys
+import re
 import time
+import logging
+import queue
+import datetime
 import struct
 import numpy as np
 import threading
-from pytrios.TClasses import TProtocolError, TPackMeasKeyError, TPacket, TSerial, TCommandSend
+from pytrios.TClasses import TProtocolError, TPackMeasKeyError, TPacket, TSerial, TCommandSend, TCommandSendBatch, DATA_OFFSET, SAM_TYPES
 
+log = logging.getLogger('pt1')
 
 tchannels = {}
+# set by the parser whenever a query reply registers a channel
+query_received = threading.Event()
+
+# payload formats: SAM pixels are little endian uint16
+_SAM_DTYPE = np.dtype('<u2')
+_MF_STRUCT = struct.Struct('>H')  # MicroFlu only reports the first word
+# MicroFlu counts to calibrated units by gain bit (0 = high, 1 = low)
+_GAIN_SCALE = (10.0 / 2048, 100.0 / 2048)
+
+# escape sequences: xOff, xOn, data start # and the escape char @ itself
+_ESC_RE = re.compile(rb'@([gfed])')
+_ESC_MAP = {b'g': b'\x13', b'f': b'\x11', b'e': b'\x23', b'd': b'\x40'}
 
 
 def handlePacket(ser, packet):
@@ -40,11 +56,11 @@ def handlePacket(ser, packet):
     p = packet  # shorten
     if p.packetType is None:
         if ser.verbosity >= 1:
-            print("handlePacket: empty packet", file=sys.stderr)
+            log.error("handlePacket: empty packet on %s", ser.port)
 
     if p.packetType == 'error':
         if ser.verbosity >= 1:
-            print("handlePacket: error packet", file=sys.stderr)
+            log.error("handlePacket: error packet on %s", ser.port)
 
     if p.packetType == 'query':
         if p.tchannel.TInfo.ModuleType == 'IPS':
@@ -68,276 +84,324 @@ def handlePacket(ser, packet):
         command = cont_on_off[ch.TMicroFlu.Settings.CtlContn]
         TCommandSend(ser, commandset='MicroFlu',
                      ipschan=ch.TInfo.TID[0:2], command=command)
+        query_received.set()
 
     if p.packetType == 'mfconfig':
-        port_tid = ser.port + '_' + p.TID
-        # update ROMconfig on existing channel
-        try:
-            tchannels[port_tid].ROMConfig = p.microFluConfig
-        except KeyError:
-            if ser.verbosity >= 1:
-                emsg = "handlePacket (mfconfig):" +\
-                    " no MicroFlu registered on {0}"\
-                    .format(port_tid)
-                raise Warning(emsg)
-        except:
+        # config replies come from address A4, the channel is registered
+        # under the MicroFlu's own address (00)
+        port_tid = ser.port + '_' + p.tid1 + p.tid2 + '00'
+        ch = tchannels.get(port_tid)
+        if ch is None:
             if ser.verbosity >= 1:
-                emsg = "handlePacket (mfconfig): MicroFlu " +\
-                    " config update failed on {0}"\
-                    .format(port_tid)
-                raise Warning(emsg)
+                log.warning("handlePacket (mfconfig): no MicroFlu "
+                            "registered on %s", port_tid)
+        else:
+            # update ROMconfig on existing channel
+            ch.TMicroFlu.ROMConfig = p.microFluConfig
 
     if p.packetType == 'query' and\
-            p.tchannel.TInfo.ModuleType in ['SAMIP', 'SAM']:
+            p.tchannel.TInfo.ModuleType in SAM_TYPES:
         ch = p.tchannel
         ch.serial = ser
         port_tid = ser.port + '_' + p.TID
         tchannels[port_tid] = ch
+        query_received.set()
 
     if p.packetType == 'measurement':
-        if int(p.tid3) in [20, 30]:
-            port_tid = ser.port + '_' + p.TID[0:4] + '80'
+        if p.moduleID in (0x20, 0x30):
+            # SAMIP submodules report under the SAMIP address (80)
+            port_tid = ser.port + '_' + p.tid1 + p.tid2 + '80'
         else:
             port_tid = ser.port + '_' + p.TID
-        interpreter = ''
-        try:
-            ch = tchannels[port_tid]
-        except KeyError:
-            emsg = "handlePacket (measurement):" +\
-                " invalid address: {0}".format(port_tid)
-            raise TPackMeasKeyError(emsg)
-        try:
-            if int(p.tid3) == 0:
-                if tchannels[port_tid].TInfo.ModuleType in['SAM', 'SAMIP']:
-                    interpreter = 'SAM'
-                elif tchannels[port_tid].TInfo.ModuleType == 'MicroFlu':
-                    interpreter = 'MicroFlu'
-            elif int(p.tid3) == 20 and tchannels[port_tid].TInfo.ModuleType\
-                    in ['COM', 'SAMIP']:
-                # p.TID = p.tid1 + p.tid2 + '80'  # probably not necessary
-                interpreter = 'ADM'
-                if ch.verbosity >= 4:
-                    print("ADM measurement received (not implemented",
-                          file=sys.stdout)
-            elif int(p.tid3) == 30 and tchannels[port_tid].TInfo.ModuleType\
-                    in ['COM', 'SAMIP']:
-                # p.TID = p.tid1 + p.tid2 + '80'  # probably not necessary
-                interpreter = 'SAM'
-            # port_tid = ser.port + '_' + p.TID  # probably not necessary
-            if interpreter == 'MicroFlu':
-                tchannels[port_tid] = MFInterpreter(tchannels[port_tid], p)
-
-            elif interpreter == 'SAM':
-                ch = SAMInterpreter(tchannels[port_tid], p)
-                tchannels[port_tid] = ch
-        except Exception as emsg:
-            raise TProtocolError(emsg)
+        ch = tchannels.get(port_tid)
+        if ch is None:
+            # not (yet) registered by a query reply
+            if ser.verbosity >= 1:
+                log.warning("handlePacket (measurement): invalid address: %s",
+                            port_tid)
+            return
+        interpreter = _INTERPRETERS.get((p.moduleID, ch.TInfo.ModuleType))
+        if interpreter is not None:
+            try:
+                interpreter(ch, p)  # updates the channel in place
+            except Exception as emsg:
+                raise TProtocolError(emsg)
+        elif p.moduleID == 0x20 and ch.verbosity >= 4:
+            log.debug("ADM measurement received (not implemented)")
 
 
 def SAMInterpreter(regch, packet):
-    formatstring = '<'+'H'*int(packet.id1_databytes/2)
-    rawdata = bytearray(y for y in packet.databytes)
-    LEdata = struct.unpack(formatstring, rawdata)
-    """ sloppy code comment:
-    In the following, if we place LEdata directly into the dataframes slice
-    it will be overwritten upon prompt arrival of a new packet, even if this
-    concerns a different entry of the tchannels dictionary. Odd!
-    Reading and writing back the list of dataframes first circumvents this.
-    Packets arriving in rapid succession re-use memory blocks. So this
-    possibly points to sloppy garbage collection?
-    """
-    dataframes = regch.TSAM.dataframes[:]
-    dataframes[packet.framebyte] = LEdata
-    regch.TSAM.dataframes = dataframes
+    tsam = regch.TSAM
+    fb = packet.framebyte
+    if fb > 7:
+        raise TProtocolError("SAM Interpreter: invalid framebyte {0}"
+                             .format(fb))
+    nwords = packet.id1_databytes // 2
+    if tsam._spectrum is None or len(tsam._spectrum) != 8*nwords:
+        tsam._spectrum = np.empty(8*nwords, dtype=_SAM_DTYPE)
+        tsam._frames = 0
+    # frames arrive 7..0, frame 7 holds the first pixels
+    pos = (7-fb)*nwords
+    tsam._spectrum[pos:pos+nwords] = np.frombuffer(packet._buf,
+                                                   dtype=_SAM_DTYPE,
+                                                   count=nwords,
+                                                   offset=DATA_OFFSET)
+    tsam._frames |= 1 << fb
     if regch.verbosity >= 4:
-        print("SAMInterpreter: Spectrum framebyte {0} from {1} at {2}/{3}"
-              .format(packet.framebyte, regch.TInfo.serialn,
-                      regch.serial.port, regch.TInfo.TID),
-              file=sys.stdout)
-    if packet.framebyte == 0:
-        frames = regch.TSAM.dataframes
-        if sum(y is None for y in frames) == 0:
-            outspec = []
-            for sublist in frames:
-                sl = list(sublist)
-                sl.reverse()
-                outspec = outspec+sl
-            outspec.reverse()  # assuming this is not a UV sensor..
-            regch.TSAM.lastRawSAM = outspec
-            regch.TSAM.lastRawSAMTime = packet.timeStampPC
-            msintt = 2*2**(outspec[0] & 0b1111)  # integration time
-            regch.TSAM.lastIntTime = msintt
-            # reset to receive the next spectrum
-            regch.TSAM.dataframes = [[None]]*8
+        log.debug("SAMInterpreter: Spectrum framebyte %s from %s at %s/%s",
+                  fb, regch.TInfo.serialn, regch.serial.port, regch.TInfo.TID)
+    if fb == 0:
+        complete = tsam._frames == 0xFF
+        tsam._frames = 0  # reset to receive the next spectrum
+        if complete:
+            # copy, so the next spectrum does not overwrite this one
+            outspec = tsam._spectrum.copy()  # assuming this is not a UV sensor..
+            tsam.lastRawSAM = outspec
+            tsam.lastRawSAMTime = packet.timeStampPC
+            tsam.lastRawSAMTime_pc = packet.timeStampPerf
+            msintt = 2 << (int(outspec[0]) & 0b1111)  # integration time
+            tsam.lastIntTime = msintt
+            if regch.is_finished():
+                regch.measured.set()
             if regch.verbosity >= 2:
                 delay = packet.timeStampPC - regch.lasttrigger
-                print("SAMInterpreter: Spectrum ({3}ms) from {0}, {1} ({2} s)"
-                      .format(regch.TInfo.serialn, regch.TInfo.TID,
-                              delay.total_seconds(), msintt),
-                      file=sys.stdout)
+                log.info("SAMInterpreter: Spectrum (%sms) from %s, %s (%s s)",
+                         msintt, regch.TInfo.serialn, regch.TInfo.TID,
+                         delay.total_seconds())
         else:
             emsg = "SAM Interpreter: Incomplete spectrum, discarded"
-            print(emsg, file=sys.stderr)
+            log.warning(emsg)
             raise TProtocolError(emsg)
-            # reset to receive the next spectrum
-            regch.TSAM.dataframes = [[None]]*8
     return regch
 
 
 def MFInterpreter(regch, packet):
     # byteorder is big endian although documentation suggests different
-    formatstring = '>'+'H'*int(packet.id1_databytes/2)
-    BEdata = struct.unpack(formatstring,
-                           ''.join([chr(y) for y in packet.Databytes]))
+    BEdata = _MF_STRUCT.unpack_from(packet._buf, DATA_OFFSET)
     gain = BEdata[0] >> 15  # 0 = high gain, 1 = low gain
     data = BEdata[0] & 0b111111111111
     regch.TMicroFlu.lastFluRaw = [gain, data]
     regch.TMicroFlu.lastFluTime = packet.timeStampPC
-    if gain == 1:
-        regch.TMicroFlu.lastFluCal = 100*data/np.float(2048)
-    if gain == 0:
-        regch.TMicroFlu.lastFluCal = 10*data/np.float(2048)
-        if regch.verbosity > 1:
-            gains = ['H', 'L']
-            ftypes = [None, 'Chl', 'Blue', 'CDOM', 'unknown', 'Red']
-            ftype = ftypes[regch.TMicroFlu.Settings.Ftype]
-            if regch.verbosity >= 3:
-                print("MicroFlu Interpreter: Microflu-{0} data on {1}/{2}\n\t"
-                      + "gain {3}, raw {4}, cal {5}"
-                      .format(ftype, regch.serial.port, regch.TInfo.TID,
-                              gains[gain], data,
-                              regch.TMicroFlu.lastFluCal), file=sys.stdout)
+    regch.TMicroFlu.lastFluCal = data * _GAIN_SCALE[gain]
+    if regch.is_finished():
+        regch.measured.set()
+    if regch.verbosity >= 3:
+        gains = ['H', 'L']
+        ftypes = [None, 'Chl', 'Blue', 'CDOM', 'unknown', 'Red']
+        ftype = ftypes[regch.TMicroFlu.Settings.Ftype]
+        log.debug("MicroFlu Interpreter: Microflu-%s data on %s/%s\n\t"
+                  "gain %s, raw %s, cal %s",
+                  ftype, regch.serial.port, regch.TInfo.TID,
+                  gains[gain], data, regch.TMicroFlu.lastFluCal)
     return regch
 
 
-def TMonitor(ports, baudrate=9600):
-    """Initiate serial port listening threads. Start here."""
+# measurement interpreters by (module ID, registered module type)
+# module ID 0x20 (ADM on SAMIP/COM) is not interpreted
+_INTERPRETERS = {(0x00, 'SAM'): SAMInterpreter,
+                 (0x00, 'SAMIP'): SAMInterpreter,
+                 (0x00, 'MicroFlu'): MFInterpreter,
+                 (0x30, 'COM'): SAMInterpreter,
+                 (0x30, 'SAMIP'): SAMInterpreter}
+
+
+def TMonitor(ports, baudrate=9600, low_latency=False):
+    """Initiate serial port listening threads. Start here.
+    *low_latency* requests the Linux ASYNC_LOW_LATENCY mode (e.g. FTDI)"""
     try:
-        if not type(ports) is list:
+        if not isinstance(ports, list):
             ports = [ports]
         COMobjslst = []
+        # one parser thread for all ports, so parsing never delays draining
+        parse_q = queue.Queue()
+        threadparse = threading.Thread(target=TParse, args=(parse_q,))
         for p in ports:
-            ser = TSerial(p, timeout=0.01, baudrate=baudrate, xonxoff=True,
-                          parity='N', stopbits=1, bytesize=8)
+            # listening threads block in read until data arrives or timeout
+            ser = TSerial(p, timeout=0.1, baudrate=baudrate, xonxoff=True,
+                          parity='N', stopbits=1, bytesize=8,
+                          low_latency=low_latency)
             ser.verbosity = 1
             if ser.isOpen():
-                # associated port listening thread
+                # associated port listening thread, framing blocks only
                 ser.threadlisten = threading.Thread(target=TListen,
                                                     args=(ser,))
+                ser.parse_q = parse_q
+                ser.threadparse = threadparse
+                ser.parse_ports = COMobjslst  # ports sharing the parser
                 ser.threadlive = threading.Event()   # clear to stop thread
                 ser.threadactive = threading.Event()  # clear to pause thread
                 ser.threadlive.set()
                 ser.threadactive.set()
                 COMobjslst.append(ser)
+                if not threadparse.is_alive():
+                    threadparse.start()
                 ser.threadlisten.start()  # start thread
                 ser.threadlisten.join(0.01)  # join calling thread
         if sum([1 for c in COMobjslst if c.isOpen()]) == 0:
             raise ValueError("TMonitor: no COM ports to watch")
-            sys.exit(1)
         return COMobjslst
     except:
         TClose(COMobjslst)
-        print("Uncaught exception. Threads and serial port(s) stopped.")
+        log.error("Uncaught exception. Threads and serial port(s) stopped.")
         raise
 
 
+def _next_block(s, ser, scanned=0):
+    """frame the next data block from raw (escaped) bytes in *s*,
+    consuming them in place. Returns None if no complete block is buffered.
+    *scanned*: leading bytes of *s* already searched for a second '#'"""
+    while True:
+        first = s.find(b'#')
+        if first < 0:
+            del s[:]  # no packet start, nothing worth keeping
+            return None
+        del s[:first]  # omit incomplete sequence at start
+
+        # escaped packets never contain '#', so a block ends at the next one
+        nxt = s.find(b'#', max(1, scanned - first))
+        if nxt < 0:
+            # unescaping only shrinks a block, skip it while too short
+            if len(s) < 2 or (s[1] != 0x40 and
+                              len(s) < 8 + (2 << (s[1] >> 5))):
+                return None
+            raw = s[1:]
+            if raw.endswith(b'@'):
+                raw = raw[:-1]  # escape sequence split across reads
+        else:
+            raw = s[1:nxt]
+        block = TStrRepl(bytes(raw))  # correct replacement chars
+        if len(block) < 1:  # 1st byte after # = size
+            if nxt < 0:
+                return None
+            del s[:nxt]  # empty block ('##'), skip to the next start
+            scanned = 0
+            continue
+
+        ndatabytes = 2*2**(block[0] >> 5)
+        blocklength = 7+ndatabytes
+        if len(block) >= blocklength:
+            s2parse = block[:blocklength]  # block to parse
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("TListen %s: %s", ser.port, s2parse.hex(':'))
+            if nxt > 0:
+                del s[:nxt]  # remainder to next cycle
+            else:
+                del s[:]
+            return s2parse
+        elif nxt < 0:
+            return None
+        del s[:nxt]  # truncated block followed by a new one, drop it
+        scanned = 0
+
+
 def _get_s2parse(s, ser):
-    "extract data blocks from serial buffer"
+    """extract data blocks from serial buffer
+    *s* is a bytearray holding raw (escaped) bytes, consumed in place.
+    Blocks for at most the port timeout when no complete block is buffered"""
     try:
-        bitsatport = ser.inWaiting()
-        if max([bitsatport, len(s)]) < 1:
-            return s, None
-
-        s = s+ser.read(1000)
-        first, last = s.find(b'#'), s.rfind(b'#')
-        s = TStrRepl(s)  # correct replacement chars
-        if first < 0 or not last >= first:
-            return s, None
-
-        s = s[s.find(b'#', 0):]  # omit incomplete sequence at start
-        if len(s) <= 1:  # 1st byte after # = size
-            return s, None
-
-        ndatabytes = 2*2**(s[1] >> 5)
-        blocklength = 8+ndatabytes
-        if len(s) >= blocklength:
-            s2parse = s[1:blocklength]  # block to parse
-            if ser.verbosity >= 4:
-                prettyhex = ":".join("{0:x}".format(c) for c in s2parse)
-                print("TListen: {0}".format(prettyhex), file=sys.stdout)
-            s = s[blocklength:]  # remainder to next cycle
-            return s, s2parse
-        else:
-            return s, None
+        s2parse = _next_block(s, ser)
+        if s2parse is None:
+            # wait for the OS to deliver data, then drain what is queued
+            chunk = ser.read(1)
+            if chunk:
+                # skip rescanning only if the leftover holds a single '#'
+                scanned = len(s) if s.find(b'#', 1) < 0 else 0
+                s += chunk
+                n = ser.in_waiting
+                if n:
+                    s += ser.read(n)
+                s2parse = _next_block(s, ser, scanned)
+        return s, s2parse
     except TProtocolError as e:
-        print("{0} {1}".format(e.message, ser.port), file=sys.stderr)
-        pass
+        log.error("%s %s", e, ser.port)
+        return s, None
     except Exception:
         raise
 
 
 def TListen(ser):
-    """Monitors and maintains a serial port instance *ser*"""
-    print("Start listening thread on {0}".format(ser.port), file=sys.stdout)
-    s = b""
-    timeouttimer = 0
-    while ser.threadlive.isSet():
-        while ser.threadactive.isSet():
+    """Monitors and maintains a serial port instance *ser*.
+    Framed blocks are queued on *ser.parse_q* for the parser thread,
+    tagged with their port"""
+    log.info("Start listening thread on %s", ser.port)
+    s = bytearray()
+    deadline = 0.0  # for a partial block to complete, 0 if none pending
+    # bound once, used on every pass
+    live, active = ser.threadlive.is_set, ser.threadactive.is_set
+    put, now = ser.parse_q.put, datetime.datetime.now
+    perf = time.perf_counter
+    while live():
+        while active() and live():
             s, s2parse = _get_s2parse(s, ser)
             if s2parse is not None:
-                timeouttimer = 0     # reset timeout
-                try:
-                    packet = TPacket(s2parse)
-                    if packet is None:
-                        if ser.verbosity >= 1:
-                            print("TListen: bad packet on port {0}"
-                                  .format(ser.port), file=sys.stderr)
-                    else:
-                        handlePacket(ser, packet)
-                except TProtocolError as msg:
-                    raise Warning(msg)
-                except TPackMeasKeyError as msg:
-                    raise Warning(msg)
-                    if ser.isOpen:
-                        ser.flushOutput()
-                        ser.flushInput()
-                        s = ''
-                        # resend query?
-                    else:
-                        raise Exception('Unrecoverable error - reboot sensors')
-                        sys.exit(1)
-                except Exception as msg:
-                    raise Warning(msg)
-            elif timeouttimer - time.time() > 1:
-                s = ""  # clear the buffer
-                emsg = "Timeout while parsing buffer"
-                raise Warning(emsg)
-            elif timeouttimer == 0:  # set a new timer
-                timeouttimer = time.time()
-            time.sleep(0.02)  # pace this cycle
-        time.sleep(0.1)  # check threadactive periodically to resume
+                deadline = 0.0  # reset timeout
+                # stamp on arrival, not when the parser gets to it
+                put((ser, s2parse, now(), perf()))
+            elif not s:
+                deadline = 0.0  # idle, nothing to time out
+            elif deadline == 0.0:  # set a new timer
+                deadline = time.monotonic() + 1.0
+            elif time.monotonic() > deadline:
+                s = bytearray()  # clear the buffer
+                deadline = 0.0
+                log.warning("Timeout while parsing buffer on %s, "
+                            "partial block discarded", ser.port)
+        ser.threadactive.wait(1.0)  # paused, returns as soon as resumed
+
+
+def TParse(parse_q):
+    """Parses blocks framed by TListen and updates tchannels.
+    *parse_q* holds (port, block, timestamp, perf_counter) items.
+    Stops when None is queued"""
+    while True:
+        item = parse_q.get()
+        if item is None:
+            return
+        ser, s2parse, timestamp, timestamp_pc = item
+        try:
+            packet = TPacket(s2parse, timestamp, timestamp_pc)
+            if packet is None:
+                if ser.verbosity >= 1:
+                    log.error("TParse: bad packet on port %s", ser.port)
+            else:
+                handlePacket(ser, packet)
+        # the parser is shared by all ports: log and carry on with the next
+        # block, raising here would stop data from every sensor
+        except (TProtocolError, TPackMeasKeyError) as msg:
+            if ser.verbosity >= 1:
+                log.warning("TParse: %s on port %s", msg, ser.port)
+        except Exception:
+            log.exception("TParse: unexpected error on port %s", ser.port)
 
 
 def TClose(COMs):
     errors = ''
-    if not type(COMs) is list:
+    if not isinstance(COMs, list):
         COMs = [COMs]
     for c in COMs:
-        print("Closing ports", file=sys.stdout)
+        log.info("Closing port %s", c.port)
         try:
-            c.threadactive.clear()
             c.threadlive.clear()
+            c.threadactive.set()  # wake a paused listener to see it stop
+            c.cancel_read()  # release a listening thread blocked in read
+            c.threadlisten.join(1.0)
             c.close()
+            if not any(o.isOpen() for o in c.parse_ports):
+                c.parse_q.put(None)  # parser stops after queued blocks
+                c.threadparse.join(1.0)
         except Exception:
-            print("Error closing port {0}".format(c.port), file=sys.stderr)
+            log.error("Error closing port %s", c.port)
             errors = '(with errors)'
             pass
-    print("Finished closing ports {0}".format(errors), file=sys.stdout)
+    log.info("Finished closing ports %s", errors)
 
 
 def TStrRepl(s):
-    s = s.replace(b'@g', b'\x13')  # correct for escape chars (xOFF)
-    s = s.replace(b'@f', b'\x11')  # correct for escape chars (xOn)
-    s = s.replace(b'@e', b'\x23')  # correct for escape chars (data start #)
-    s = s.replace(b'@d', b'\x40')  # correct for escape chars (escape char @)
-    return s
+    "correct for escape chars in a single pass"
+    if b'@' not in s:
+        return s  # most blocks carry no escapes
+    return _ESC_RE.sub(_esc_sub, s)
+
+
+def _esc_sub(m):
+    return _ESC_MAP[m.group(1)]
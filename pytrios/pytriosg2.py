@@ -246,7 +246,7 @@ def read_last_meas(mod):
 
     try:
         g2.spectrum = list(g2.raw_ordinate0['value'] + g2.raw_ordinate1['value'])
-    except:
+    except Exception:
         log.warning(f"Failed to construct spectrum")
         g2.spectrum = None
 
@@ -299,25 +299,42 @@ def write_single_command(mod_serial, slave_id, function_code, register_address,
 def read_one_register(mod, register_name='system_date_and_time', slave_address=1):
     """perform request and read operation by register name"""
 
+    result = read_registers(mod, [register_name], slave_address=slave_address)
+    if result is None:
+        return None
+    return result[register_name]
+
+
+def read_registers(mod, register_names, slave_address=1):
+    """read several neighbouring registers in one request (at most 125 registers in total).
+    Returns a dict of values by register name, or None if the read failed"""
+
     g2 = G2registers()
-    reg = g2.__dict__[register_name]
-    response = read_command(mod['serial'], slave_address, 3, reg['start'], reg['len'], timeout=reg['timeout'])
+    regs = [g2.__dict__[name] for name in register_names]
+    start = min(reg['start'] for reg in regs)
+    count = max(reg['start'] + reg['len'] for reg in regs) - start
+    timeout = max(reg['timeout'] for reg in regs)
+    response = read_command(mod['serial'], slave_address, 3, start, count, timeout=timeout)
 
     if response == b'':  # nothing received, try once more but slower.
         log.debug("No response, trying again.. ")
-        response = read_command(mod['serial'], slave_address, 3, reg['start'], reg['len'], timeout=reg['timeout']*2)
+        response = read_command(mod['serial'], slave_address, 3, start, count, timeout=timeout*2)
 
-    datatype = reg['datatype']
     try:
         crc_check_incoming(response)
     except CrcError as err:
-        log.warning(f"CRC check failed on register {register_name}: {response}")
+        log.warning(f"CRC check failed on registers {register_names}: {response}")
         return None
     except CrcEmptyMessage as err:
-        log.debug(f"CRC check: empty response on register {register_name}")
+        log.debug(f"CRC check: empty response on registers {register_names}")
         return None
 
-    result = unpack_response(response, datatype)
+    # each register holds 2 bytes, offset from the first register read
+    datablock = response[3: 3+int(response[2])]
+    result = {}
+    for reg in regs:
+        offset = 2 * (reg['start'] - start)
+        result[reg['name']] = parse_data_types(datablock[offset: offset + 2*reg['len']], reg['datatype'])
 
     return result
 
@@ -395,10 +412,9 @@ def parse_data_types(datablock, datatype):
             data = struct.unpack(datatype, datablock)
             if len(data) == 1:
                 data = data[0]
-    except:
+    except Exception:
         log.warning(f"Could not parse {datablock}, {data_hex}, {len(datablock)} as {datatype}")
         data = None
-        pass
 
     log.debug(f"data hex/int: {data_hex} / {data}")
     return data
@@ -487,7 +503,7 @@ def report_slave_id(mod, slave_id=1, timeout=3.0):
         version = response[3:-2].split(b'\x00')[3].decode('ascii')
         log.info(f"{mod['serial'].port}: {make} | {model} | {serialn} | {version}")
         return serialn
-    except:
+    except Exception:
         log.info(f"No TriOS G2 response on {mod['serial'].port}: {response}")
         return None
 
@@ -20,11 +20,15 @@ import logging
 import threading
 import pytrios.pytriosg2 as pt2
 import pytrios.pytriosg1 as ps
-from numpy import log2
+from pytrios.TClasses import TIMEOUT_SAM, SAM_TYPES, set_low_latency
 
 log = logging.getLogger('rad')
 log.setLevel('INFO')
 
+# G2 integration time register index by integration time in ms: 0 (auto), 4 ms -> 1 .. 8192 ms -> 12
+INTTIME_INDEX = {0: 0}
+INTTIME_INDEX.update({1 << n: n - 1 for n in range(2, 14)})
+
 
 class TriosG2Manager(object):
     """
@@ -68,18 +72,17 @@ class TriosG2Manager(object):
             instrument.connect()
             instrument.get_identity()
 
-        t0 = time.perf_counter()
-        while ((time.perf_counter() - t0) < timeout) and (len(instruments_defined) > 0):
-            for instrument in instruments_defined:
-                if (not instrument.busy) and (instrument.ready) and (instrument not in self.instruments):
-                    log.info(f"{instrument.mod['port']}: sensor {instrument.sam} connected.")
-                    self.instruments.append(instrument)
-                    self.sams.append(instrument.sam)
-                    instruments_defined.remove(instrument)
-            time.sleep(0.1)
-
+        # wait for each sensor thread to report its identity, up to the shared timeout
+        deadline = time.monotonic() + timeout
+        for instrument in instruments_defined:
+            instrument.identified.wait(max(0, deadline - time.monotonic()))
         for instrument in instruments_defined:
-            log.warning(f"{instrument.mod['port']}: sensor connection unsuccessful.")
+            if instrument.identified.is_set() and instrument.ready:
+                log.info(f"{instrument.mod['port']}: sensor {instrument.sam} connected.")
+                self.instruments.append(instrument)
+                self.sams.append(instrument.sam)
+            else:
+                log.warning(f"{instrument.mod['port']}: sensor connection unsuccessful.")
 
         self.ready = True
         self.busy = False
@@ -99,47 +102,42 @@ class TriosG2Manager(object):
                 instruments_included = [inst for inst in self.instruments if inst.sam in sams_included]
 
             for instrument in instruments_included:
-                # set integration time
-                instrument.set_integration_time(inttime)
-                # trigger single measurement
-                instrument.sample_one(trigger_time)
-
-            # follow progress
-            t0 = time.perf_counter()
-            npending = sum([i.busy for i in instruments_included])
-            while (npending > 0) and (time.perf_counter() - t0 < 30):
-                npending = sum([i.busy for i in instruments_included])
-                time.sleep(0.05)
-
-            if npending > 0:
+                # trigger single measurement, the sensor thread sets the integration time while waiting for the trigger time
+                instrument.sample_one(trigger_time, inttime=inttime)
+
+            # follow progress, waiting for each sensor thread to finish its sample
+            deadline = time.monotonic() + 30
+            for i in instruments_included:
+                i.sampled.wait(max(0, deadline - time.monotonic()))
+            pending = [i.sam for i in instruments_included if i.busy]
+
+            if len(pending) > 0:
                 # one or more instruments did not return a result
-                pending = [i.sam for i in instruments_included if i.busy]
-                log.warning(f"Timeout: missing result from {','.join([p for p in pending])}")
+                log.warning(f"Timeout: missing result from {','.join(pending)}")
 
-            instruments_valid = []
+            # select and gather succesful results in one pass
+            sids, specs, itimes, pre_incs, post_incs, temp_incs, delaysec = [], [], [], [], [], [], []
             for i in instruments_included:
-                if (i.result is None) or (i.result.spectrum is None) or (instrument.last_received < instrument.last_sampled):
+                if i.busy or not i.sampled.is_set():
+                    continue  # still sampling, reported as missing above
+                result = i.result
+                if (result is None) or (result.spectrum is None) or (i.last_received_ns is None) or (i.last_received_ns < i.last_sampled_ns):
                     log.warning(f"No new measurement from {i.sam}")
-                else:
-                    instruments_valid.append(i)
+                    continue
+                sids.append(i.sam)
+                specs.append(result.spectrum)
+                itimes.append(result.integration_time['value'])
+                pre_incs.append(result.pre_inclination['value'])
+                post_incs.append(result.post_inclination['value'])
+                temp_incs.append(result.temp_inclination_sensor['value'])
+                delaysec.append((i.last_received_ns - i.last_sampled_ns) / 1e9)
 
-            nfinished = len(instruments_valid)
+            nfinished = len(sids)
 
             # how long did the measurements take to arrive?
             if nfinished > 0:
-                delays = [i.last_received - i.last_sampled for i in instruments_valid]
-                delaysec = [d.total_seconds() for d in delays]
                 log.info(f"{nfinished} spectra received, triggered at {trigger_time} ({','.join([str(d) for d in delaysec])} s)")
 
-            # gather succesful results
-            results = [instrument.result for instrument in instruments_valid]
-            sids =  [instrument.sam for instrument in instruments_valid]
-            specs = [result.spectrum for result in results]
-            itimes = [result.integration_time['value'] for result in results]
-            pre_incs = [result.pre_inclination['value'] for result in results]
-            post_incs = [result.post_inclination['value'] for result in results]
-            temp_incs = [result.temp_inclination_sensor['value'] for result in results]
-
             self.busy = False
             return trigger_time, specs, sids, itimes, pre_incs, post_incs, temp_incs  # specs, sids, itimes etc may be empty lists
 
@@ -157,17 +155,25 @@ class TriosG2Ramses(object):
         # sampling properties
         self.busy = False    # True if the sensor is used for something (a very soft lock)
         self.ready = False   # True if a sensor is connected
+        self.identified = threading.Event()  # set by the thread once an identity request has been handled
+        self.sampled = threading.Event()     # set by the thread once a sample request has been handled
+        self.request = threading.Event()     # wakes the thread for a new request or stop
         # thread properties
         self.started = False
         self.stop_monitor = False
-        self.sleep_interval = 0.05  # time between thread cycles
+        self.sleep_interval = 0.05  # stop() allows the thread twice this to finish
         # command requests
         self.identify = False  # if set True, sensor info will be requested. Use get_identity() to set.
         self.trigger_sample = False  # store instruction for next sampling event. use sample_one() to set.
+        self.trigger_deadline = None  # time.monotonic() at which to sample, None to sample immediately
+        self.trigger_inttime = None  # integration time (ms) to set before the next sample, None to leave as is
         # results
         self.result = None  # store latest sample result
         self.last_sampled = None
         self.last_received = None
+        self.last_sampled_ns = None  # time.monotonic_ns() equivalents of the above, used for delays
+        self.last_received_ns = None
+        self.inttime_index = None  # integration time register value as last read from the sensor
 
     def __del__(self):
         self.stop()
@@ -196,21 +202,23 @@ class TriosG2Ramses(object):
 
         log.info(f"{self.mod['port']}: connecting to radiometer")
         pt2.open_modbus(self.mod)
+        if self.mod['serial'] is not None:
+            set_low_latency(self.mod['serial'])
 
-        sleeptime = None
+        # sleep state and measurement timer are neighbouring registers, read both in one request
+        timers = None
         t0 = time.perf_counter()
         timeout = 15
-        log.info(f"{self.mod['port']}: checking sensor sleep state")
-        while (sleeptime is None) and ((time.perf_counter() - t0) < timeout):
-            sleeptime = pt2.read_one_register(self.mod, 'deep_sleep_timeout')
-            if sleeptime is None:
+        log.info(f"{self.mod['port']}: checking sensor sleep state and measurement timer")
+        while (timers is None) and ((time.perf_counter() - t0) < timeout):
+            timers = pt2.read_registers(self.mod, ['measurement_timeout', 'deep_sleep_timeout'])
+            if timers is None:
+                # the read itself waits for the sensor to wake up, no extra pause needed
                 log.warning(f"{self.mod['port']}: failed to read sensor sleep state. Retry for {timeout - (time.perf_counter() - t0):2.1f} s")
-                time.sleep(1.0)
             else:
-                log.info(f"{self.mod['port']}: deep sleep status/time: {sleeptime}")
+                log.info(f"{self.mod['port']}: deep sleep status/time: {timers['deep_sleep_timeout']}")
 
-        log.info(f"{self.mod['port']}: checking sensor measurement timer")
-        meastime = pt2.read_one_register(self.mod, 'measurement_timeout')
+        meastime = None if timers is None else timers['measurement_timeout']
         if meastime is None:
             log.warning(f"{self.mod['port']}: failed to read sensor measurement timer.")
         elif meastime >= 0:
@@ -224,7 +232,7 @@ class TriosG2Ramses(object):
         if lanstate0 is None:
             log.warning(f"{self.mod['port']}: failed to detect LAN state.")
         else:
-            log.info(f"LAN state: {landstate0}")
+            log.info(f"{self.mod['port']}: LAN state: {lanstate0}")
 
         #elif lanstate0:
         #    log.info(f"{self.mod['port']}: disable LAN state.")
@@ -232,6 +240,7 @@ class TriosG2Ramses(object):
 
         log.info(f"{self.mod['port']}: checking integration time setting")
         inttime = pt2.read_one_register(self.mod, 'integration_time_cfg')
+        self.inttime_index = inttime
         if inttime is None:
             log.warning(f"{self.mod['port']}: failed to detect integration time setting.")
         else:
@@ -241,27 +250,49 @@ class TriosG2Ramses(object):
 
 
     def set_integration_time(self, inttime=0):
+        if inttime not in INTTIME_INDEX:
+            raise ValueError(f"Invalid G2 integration time {inttime} ms")
         self.busy = True
-        inttime_index = int(log2(inttime)-1)
+        self._write_integration_time(inttime)
+        self.busy = False
+
+    def _write_integration_time(self, inttime):
+        """write and verify the integration time setting, unless the sensor already has it"""
+        inttime_index = INTTIME_INDEX[inttime]
+        if inttime_index == self.inttime_index:
+            # the setting is kept by the sensor, no need to write and verify it again
+            return
         log.info(f"{self.mod['port']}: setting integration time to {inttime} ({inttime_index})")
         pt2.set_integration_time(self.mod, inttime=inttime_index)
         inttime_read = pt2.read_one_register(self.mod, 'integration_time_cfg')
+        self.inttime_index = inttime_read
         if inttime_read is None:
             log.warning(f"{self.mod['port']}: failed to detect integration time setting.")
         else:
             log.info(f"{self.mod['port']}: Integration time: {inttime_read}")
-        self.busy = False
 
 
-    def sample_one(self, trigger_time=True):
+    def sample_one(self, trigger_time=True, inttime=None):
         """
         Prime for sampling, set sensor status to busy
         trigger_time can be a datetime object or True
+        inttime (ms), if given, is set by the running thread before sampling
         The running thread will read the status and do any waiting required.
         """
+        if (inttime is not None) and (inttime not in INTTIME_INDEX):
+            raise ValueError(f"Invalid G2 integration time {inttime} ms")
         self.busy = True
+        self.sampled.clear()
+        self.result = None  # a request that fails or never runs leaves no result
+        self.trigger_inttime = inttime
+        if isinstance(trigger_time, datetime.datetime):
+            # convert to the monotonic clock once, the thread then never needs the wall clock
+            self.trigger_deadline = time.monotonic() + (trigger_time - datetime.datetime.now()).total_seconds()
+        else:
+            self.trigger_deadline = None
         self.trigger_sample = trigger_time
-        log.info(f"Next sample trigger: {self.trigger_sample}")
+        self.request.set()
+        log.info(f"{self.mod['port']}: next sample trigger: {self.trigger_sample}")
 
     def get_identity(self):
         """
@@ -269,7 +300,9 @@ class TriosG2Ramses(object):
         The running thread will read the status and reset the busy flag
         """
         self.busy = True
+        self.identified.clear()
         self.identify = True
+        self.request.set()
 
     def _identify(self):
         """called by thread monitor to identify connected sensor"""
@@ -292,7 +325,7 @@ class TriosG2Ramses(object):
         self.busy = True
         log.info(f"Stopping RAMSES G2 thread on port {self.mod['port']}")
         self.stop_monitor = True
-        time.sleep(1 * self.sleep_interval)
+        self.request.set()
         log.info(self.thread)
         self.thread.join(2 * self.sleep_interval)
         log.info(f"RAMSES G2 thread on port {self.mod['port']} running: {self.thread.is_alive()}")
@@ -300,40 +333,60 @@ class TriosG2Ramses(object):
         self.busy = False
         self.ready = False
 
+    def _finish_sample(self):
+        """release the sample request, with or without a result"""
+        self.trigger_sample = False
+        self.busy = False
+        self.sampled.set()
+
     def run(self):
         """
         Main loop of the thread.
         This will listen for requested actions and execute them, monitoring whether the sensor is available.
         """
         while not self.stop_monitor:
+            # requests set their flag before the event, so anything arriving after this is seen on the next pass
+            self.request.clear()
             if self.identify:
                 self._identify()
                 self.identify = False
+                self.identified.set()
+
+            if self.trigger_sample and (self.trigger_inttime is not None):
+                inttime, self.trigger_inttime = self.trigger_inttime, None
+                try:
+                    # set before waiting for the trigger time, the write takes about a second
+                    self._write_integration_time(inttime)
+                except Exception as err:
+                    # a missing or corrupt reply must not end the thread, drop this sample instead
+                    log.error(f"{self.mod['port']}: failed to set integration time: {err}")
+                    self.inttime_index = None  # setting unknown, write it again next time
+                    self._finish_sample()
 
             if self.trigger_sample:
-                if isinstance(self.trigger_sample, datetime.datetime):
-                    sec_remaining = (self.trigger_sample - datetime.datetime.now()).total_seconds()
+                if self.trigger_deadline is not None:
+                    sec_remaining = self.trigger_deadline - time.monotonic()
                     if sec_remaining > 0:
-                        time.sleep(self.sleep_interval)
+                        # sleep up to the trigger time, waking early for stop requests
+                        self.request.wait(sec_remaining)
                         continue
 
                 # now sample
-                log.info(f"Measurement requested on {self.mod['port']}")
-                self.result = None
+                log.info(f"{self.mod['port']}: measurement requested")
                 self.last_sampled = datetime.datetime.now()
-                self.result = pt2.sample_one(self.mod)
+                self.last_sampled_ns = time.monotonic_ns()
                 try:
+                    self.result = pt2.sample_one(self.mod)
                     if self.result.spectrum is not None:
                         self.last_received = datetime.datetime.now()
+                        self.last_received_ns = time.monotonic_ns()
                 except Exception as err:
                     log.exception(err)
-                    pass
-
-                self.trigger_sample = False
-                self.busy = False
+                finally:
+                    self._finish_sample()
 
-            time.sleep(self.sleep_interval) # sleep for a standard period, ideally close to the refresh frequency of the sensor (0.01s)
-            continue
+            # idle until the next request, no polling needed
+            self.request.wait()
 
 
 class TriosManager(object):
@@ -343,8 +396,10 @@ class TriosManager(object):
     def __init__(self, port):
         # import pytrios only if used
         self.ports = [port]  # list of strings
-        self.coms = ps.TMonitor(self.ports, baudrate=9600)
+        # low latency as for G2 ports, so small replies are not held back by USB-serial adapters
+        self.coms = ps.TMonitor(self.ports, baudrate=9600, low_latency=True)
         self.sams = []
+        self.found = None  # (channel, serial) pairs last reported
         self.ready = False
         self.connect_sensors()
         # track reboot cycles to prevent infinite rebooting of sensors if something unexpected happens (e.g a permanent sensor failure)
@@ -366,14 +421,15 @@ class TriosManager(object):
         """(re)connect all serial ports and query all sensors"""
         self.busy = True
 
+        # TClose joins the listening threads and TMonitor starts them before returning,
+        # so the ports can be queried straight away
         ps.TClose(self.coms)
         ps.tchannels = {}
-        time.sleep(1)
 
         log.info("Connecting: Starting listening threads")
-        self.coms = ps.TMonitor(self.ports, baudrate=9600)
-        time.sleep(3)
+        self.coms = ps.TMonitor(self.ports, baudrate=9600, low_latency=True)
 
+        ps.query_received.clear()
         for com in self.coms:
             # set verbosity for com channel (com messages / errors)
             # 0/1/2 = none, errors, all
@@ -381,7 +437,7 @@ class TriosManager(object):
             for chan in ['02', '04', '06', '08']:
                 # query connected instruments
                 ps.TCommandSend(com, commandset=None, ipschan=chan, command='query')
-        time.sleep(3)  # pause to receive query results
+        self._wait_query_replies()
         self._identify_sensors()
 
         if len(self.sams) == 0:
@@ -398,66 +454,81 @@ class TriosManager(object):
 
         self.busy = False
 
+    def _wait_query_replies(self, timeout=3, quiet=0.5):
+        """Wait for query results: return once no new sensor has replied for
+        *quiet* seconds, or after *timeout* seconds in total"""
+        deadline = time.monotonic() + timeout
+        wait = timeout  # nothing received yet
+        while ps.query_received.wait(max(0, min(wait, deadline - time.monotonic()))):
+            ps.query_received.clear()
+            if time.monotonic() >= deadline:
+                break
+            wait = quiet
+
     def _identify_sensors(self):
         """identify SAM instruments from identified channels"""
         self.tk = list(ps.tchannels.keys())
         self.tc = ps.tchannels
-        self.sams = [k for k in self.tk if ps.tchannels[k].TInfo.ModuleType in ['SAM', 'SAMIP']]  # keys
-        self.chns = [self.tc[k].TInfo.TID for k in self.sams]  # channel addressing
-        self.sns = [self.tc[k].TInfo.serialn for k in self.sams]  # sensor ids
+        self.sams, self.chns, self.sns = [], [], []  # keys, channel addressing, sensor ids
+        for k, ch in self.tc.items():
+            if ch.TInfo.ModuleType in SAM_TYPES:
+                self.sams.append(k)
+                self.chns.append(ch.TInfo.TID)
+                self.sns.append(ch.TInfo.serialn)
 
-        log.info("found SAM modules: {0}".format(list(zip(self.chns, self.sns))))
+        # only report the sensors when they differ from the last (re)connect
+        found = list(zip(self.chns, self.sns))
+        if found != self.found:
+            log.info("found SAM modules: {0}".format(found))
+            self.found = found
 
 
     def sample_all(self, trigger_id, sams_included=None, inttime=0):
         """Send a command to take a spectral sample from every sensor currently detected by the program"""
         self.lasttrigger = datetime.datetime.now()  # this is not used to timestamp measurements, only to track progress
+        trigger_pc = time.perf_counter()
         self.busy = True
         try:
             if sams_included is None:
                 sams_included = self.sams
 
-            for s in sams_included:
-                self.tc[s].startIntSet(self.tc[s].serial, inttime, trigger=self.lasttrigger)
-
-            # follow progress
-            npending = len(sams_included)
-            while npending > 0:
-                # pytrios has a 12-sec timeout period for sam instruments so this will not loop forever
-                # triggered measurements may not be pending but also not finished (i.e. incomplete or missing data)
-                finished = [k for k in sams_included if self.tc[k].is_finished()]
-                pending = [k for k in sams_included if self.tc[k].is_pending()]
-                nfinished = len(finished)
-                npending = len(pending)
-                time.sleep(0.05)
-
-            # account failed and successful measurement attempts
-            missing = list(set(sams_included) - set(finished))
-
-            for k in finished:
-                self.tc[k].failures = 0
-            for k in missing:
-                self.tc[k].failures +=1
+            chans = [self.tc[s] for s in sams_included]
+            # one write per port, so sensors on an IPS box start together
+            frames = {}
+            for ch in chans:
+                frames.setdefault(ch.serial, []).append(ch.startIntSetFrame(inttime, trigger=self.lasttrigger))
+            for com, f in frames.items():
+                ps.TCommandSendBatch(com, f)
+
+            # wait for each sensor to report, up to the pytrios 12-sec timeout for sam instruments
+            # triggered measurements may not be finished (i.e. incomplete or missing data)
+            deadline = time.monotonic() + TIMEOUT_SAM
+            for ch in chans:
+                ch.measured.wait(max(0, deadline - time.monotonic()))
+            # sort results, gather succesful results and account failed and successful measurement attempts in one pass
+            finished, missing = [], []
+            specs, sids, itimes = [], [], []
+            for k, ch in zip(sams_included, chans):
+                if ch.is_finished():
+                    finished.append(k)
+                    specs.append(ch.TSAM.lastRawSAM)
+                    sids.append(ch.TInfo.serialn)
+                    itimes.append(ch.TSAM.lastIntTime)
+                    ch.failures = 0
+                else:
+                    missing.append(k)
+                    ch.failures += 1
+            nfinished = len(finished)
 
             # how long did the measurements take to arrive?
             if nfinished > 0:
-                if type(self.tc[k].TSAM.lastRawSAMTime) == type(self.lasttrigger) and self.tc[k].TSAM.lastRawSAMTime is not None:
-                    delays = [self.tc[k].TSAM.lastRawSAMTime - self.lasttrigger for k in sams_included]
-                    delaysec = max([d.total_seconds() for d in delays])
-                    log.info("\t{0} spectra received, triggered at {1} ({2} s)"
-                        .format(nfinished, self.lasttrigger, delaysec))
+                delaysec = max(self.tc[k].TSAM.lastRawSAMTime_pc for k in finished) - trigger_pc
+                log.info("\t{0} spectra received, triggered at {1} ({2} s)"
+                    .format(nfinished, self.lasttrigger, delaysec))
 
             if len(missing) > 0:
                 log.warning("Incomplete or missing result from {0}".format(",".join(missing)))
 
-            # gather succesful results
-            specs = [self.tc[s].TSAM.lastRawSAM
-                    for s in sams_included if self.tc[s].is_finished()]
-            sids = [self.tc[s].TInfo.serialn
-                    for s in sams_included if self.tc[s].is_finished()]
-            itimes = [self.tc[s].TSAM.lastIntTime
-                    for s in sams_included if self.tc[s].is_finished()]
-
             self.busy = False
             pre_incs = [None]
             post_incs = [None]
@@ -13,13 +13,16 @@ confusion with similar filenames or partial calibration info.
 
 @author: stsi
 """
-from __future__ import print_function  # hello future!
 import os
 import sys
 import numpy as np
 import datetime
 
 
+# default output wavelength grid: 320 - 953.6 nm in 3.3 nm steps
+WLOUT = np.arange(320, 955, 3.3)
+
+
 def importCalFiles(CalFolder):
     folders = os.listdir(CalFolder)
     caldict = []
@@ -180,8 +183,23 @@ def _ParseIniFile(filename):
         return iniOut
 
 
+def _CalArrays(Cal):
+    """Background, air calibration and pixel wavelength arrays of a Cal,
+    computed on first use and kept on the Cal for later spectra"""
+    arrays = getattr(Cal, '_arrays', None)
+    if arrays is None:
+        # pixel wavelengths from the calibration polynomial (pixels 1..256)
+        wave = np.polyval([Cal.ini.c3s, Cal.ini.c2s, Cal.ini.c1s,
+                           Cal.ini.c0s], np.arange(1, 257))
+        arrays = (np.array(Cal.SAMspectrum_Back0),
+                  np.array(Cal.SAMspectrum_Back1),
+                  np.array(Cal.SAMspectrum_Air), wave)
+        Cal._arrays = arrays
+    return arrays
+
+
 def raw2cal_Air(spec, msdate, serialn,
-                CalData, wlOut=np.arange(320, 955, 3.3)):
+                CalData, wlOut=WLOUT):
     """Calibration IN AIR according to Trios manual, page 13+
     * spec = raw spectrum (list of int)\n
     * msdate = measurement datetime\n
@@ -189,29 +207,21 @@ def raw2cal_Air(spec, msdate, serialn,
     * CalData = set of calibration data\n
     * wlOut = output wavelength grid (numpy arange)\n"""
 
-    SAMDateTime_Air = [i.SAMDateTime_Air for i in CalData]
-    iniSensorName = [i.ini.SensorName for i in CalData]
-    out = [np.nan]*len(wlOut)
     msintt = 2*2**(spec[0] & 0b1111)
     # find best calibration match
-    calsensind = [i for i, j in enumerate(iniSensorName) if j == serialn]
+    calsensind = [i for i, c in enumerate(CalData)
+                  if c.ini.SensorName == serialn]
     # pick most recent (never in future, in case of sensor repair)
     if len(calsensind) > 1:
-        calsensdates = [SAMDateTime_Air[i] for i in calsensind]
+        calsensdates = [CalData[i].SAMDateTime_Air for i in calsensind]
         tdeltas = [(msdate-x) for x in calsensdates
                 if (msdate-x).days > 0]
         calsensind = [calsensind[tdeltas.index(min(tdeltas))]]
 
     Cal = CalData[calsensind[0]]
-    B0 = np.array(Cal.SAMspectrum_Back0)
-    B1 = np.array(Cal.SAMspectrum_Back1)
-    S = np.array(Cal.SAMspectrum_Air)
+    B0, B1, S, wave = _CalArrays(Cal)
     dp1 = Cal.ini.DarkPixelStart
     dp2 = Cal.ini.DarkPixelStop
-    wave = [0.0] * 256
-    for i in range(0, len(wave), 1):
-        wave[i] = (Cal.ini.c0s) + (Cal.ini.c1s*(i+1)) +\
-            (Cal.ini.c2s*(i+1)**2) + (Cal.ini.c3s*(i+1)**3)
 
     t0 = 8192
     t1 = msintt  # in ms
@@ -9,24 +9,39 @@ import os
 import time
 import datetime
 import argparse
+import numpy as np
+import atexit
 import logging
+import logging.handlers
+import queue
 import serial.tools.list_ports as list_ports
 import pytrios
 import pytrios.radman as radiometer_manager
 
-def single_sample(radiometry_manager, inttime, file):
+# integration times (ms) accepted per sensor type, 0 (auto) is always allowed
+INTTIME_ALLOWED = {1: frozenset([8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192]),
+                   2: frozenset([4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192])}
+
+def format_spectrum(spectrum):
+    """Comma separated spectrum values, converted to python numbers in one step"""
+    return ','.join(map(str, np.asarray(spectrum).tolist()))
+
+
+def single_sample(radiometry_manager, inttime, outfile):
     log.info(f"Trigger measurement")
     trig_id, specs, sids, itimes, preincs, postincs, inctemps  = radiometry_manager.sample_all(datetime.datetime.now(), inttime=inttime)
 
     for i, sid in enumerate(sids):
         log.info(f"Received spectrum from {sid}: {trig_id} | int-time: {itimes[i]} ms | Spectrum: {specs[i][0:3]}...{specs[i][-3::]}")
 
-        if file is not None:
-            with open(file, 'a+') as outfile:
-                outfile.write(f"{str(sid)}\t{trig_id.isoformat()}\t{str(itimes[i])}\t{','.join([str(s) for s in specs[i]])}\n")
+    if outfile is not None and len(sids) > 0:
+        # one write per trigger for all sensors, the timestamp is shared
+        trig_str = trig_id.isoformat()
+        outfile.write(''.join([f"{str(sid)}\t{trig_str}\t{str(itimes[i])}\t{format_spectrum(specs[i])}\n"
+                               for i, sid in enumerate(sids)]))
 
 
-def run_sample(port, repeat=1, type=1, inttime=0, file=None):
+def run_sample(port, repeat=1, type=1, inttime=0, file=None, period=0):
     """Test connectivity to TriOS RAMSES radiometer sensors"""
 
     if type == 1:
@@ -39,13 +54,28 @@ def run_sample(port, repeat=1, type=1, inttime=0, file=None):
 
     if rad_manager.ready:
         log.info(f"Starting {repeat} measurements (press CTRL-C to interrupt)")
-        while repeat > 0:
-            try:
-                single_sample(rad_manager, inttime, file)
-                repeat = repeat - 1
-                time.sleep(1)
-            except KeyboardInterrupt:
-                repeat = 0
+        # keep the output file open for the whole run, line buffered so each spectrum is written out
+        outfile = open(file, 'a', buffering=1) if file is not None else None
+        try:
+            # triggers follow a fixed cadence on the monotonic clock, period 0 samples back to back
+            next_trigger = time.monotonic()
+            while repeat > 0:
+                try:
+                    single_sample(rad_manager, inttime, outfile)
+                    repeat = repeat - 1
+                    if repeat > 0 and period > 0:
+                        next_trigger += period
+                        wait = next_trigger - time.monotonic()
+                        if wait > 0:
+                            time.sleep(wait)
+                        else:
+                            log.warning(f"Sampling is {-wait:.2f} s behind the {period} s period")
+                            next_trigger = time.monotonic()
+                except KeyboardInterrupt:
+                    repeat = 0
+        finally:
+            if outfile is not None:
+                outfile.close()
 
     else:
         log.warning(f"Radiometry manager not ready. Exiting")
@@ -64,6 +94,7 @@ def parse_args():
     parser.add_argument('-t', '--type', type=int, default=None, help="1 = G1 sensor, 2 = G2 sensor")
     parser.add_argument('-i', '--inttime', type=int, default=0, help="Integration time: 0 (auto), 4 (G2 only), 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192 ms")
     parser.add_argument('-f', '--file', type=str, default=None, help="Append results to file (provide file path)")
+    parser.add_argument('--period', type=float, default=0, help="time between measurement triggers in seconds (default 0: back to back)")
     args = parser.parse_args()
     return args
 
@@ -77,24 +108,22 @@ if __name__ == '__main__':
     handler.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s| %(levelname)s | %(name)s | %(message)s')
     handler.setFormatter(formatter)
-    log.addHandler(handler)
+    # console output is written by a listener thread, so slow terminals do not stall the serial threads
+    log_queue = queue.SimpleQueue()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
 
     if args.type is None:
         log.info("No device type selected. Specify G1 or G2 type")
         sys.exit()
-    elif args.type == 1:
-        if args.inttime>0:
-            if args.inttime not in [8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192]:
-                log.info("Integration time for G1 sensors must be one of 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192 ms")
-                sys.exit()
-    elif args.type == 2:
-        if args.inttime>0:
-            if args.inttime not in [4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192]:
-                log.info("Integration time for G2 sensors must be one of 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192 ms")
-                sys.exit()
-    else:
+    elif args.type not in INTTIME_ALLOWED:
         log.info("Sensor type must be 1 (G1) or 2 (G2)")
         sys.exit()
+    elif args.inttime > 0 and args.inttime not in INTTIME_ALLOWED[args.type]:
+        log.info(f"Integration time for G{args.type} sensors must be one of {', '.join(str(t) for t in sorted(INTTIME_ALLOWED[args.type]))} ms")
+        sys.exit()
 
     if args.port is None:
         log.info("No device selected. The following are available (select a serial port with the -p argument):")
@@ -103,4 +132,12 @@ if __name__ == '__main__':
             log.info("\t {0} {1} {2}".format(port, desc, hwid))
 
     else:
-        run_sample(args.port, args.repeat, args.type, args.inttime, args.file)
+        if sys.platform == 'win32':
+            # 1 ms timer resolution for sleeps and serial timeouts (default 15.6 ms)
+            import ctypes
+            ctypes.windll.winmm.timeBeginPeriod(1)
+        try:
+            run_sample(args.port, args.repeat, args.type, args.inttime, args.file, args.period)
+        finally:
+            if sys.platform == 'win32':
+                ctypes.windll.winmm.timeEndPeriod(1)
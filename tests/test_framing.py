@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Framing of G1 data blocks by the listener (pytriosg1._get_s2parse)"""
+import serial
+
+from pytrios.pytriosg1 import _get_s2parse
+
+# 8 data bytes: 6 header bytes + data + checksum, escaped on the wire
+BLOCK0 = bytes([0x40, 0x02, 0x00, 0xff, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 0])
+BLOCK1 = bytes([0x40, 0x02, 0x00, 0xff, 0, 0, 0x23, 0x40, 0x11, 0x13,
+                5, 6, 7, 8, 0])
+ESC = {0x23: b'@e', 0x40: b'@d', 0x11: b'@f', 0x13: b'@g'}
+
+
+def _wire(block):
+    return b'#' + b''.join(ESC.get(c, bytes([c])) for c in block)
+
+
+def _frame(chunks, passes=5):
+    """feed *chunks* to a loopback port one read at a time"""
+    ser = serial.serial_for_url('loop://', timeout=0.01)
+    s, out = bytearray(), []
+    try:
+        for chunk in chunks:
+            ser.write(chunk)
+            for _ in range(passes):
+                s, s2parse = _get_s2parse(s, ser)
+                if s2parse is not None:
+                    out.append(s2parse)
+    finally:
+        ser.close()
+    return out
+
+
+def test_consecutive_blocks():
+    assert _frame([_wire(BLOCK0) + _wire(BLOCK1) + b'#']) == [BLOCK0, BLOCK1]
+
+
+def test_empty_block_is_skipped():
+    data = b'##' + _wire(BLOCK0) + _wire(BLOCK1) + b'#'
+    assert _frame([data]) == [BLOCK0, BLOCK1]
+
+
+def test_empty_block_then_split_reads():
+    data = b'##' + _wire(BLOCK0) + _wire(BLOCK1) + _wire(BLOCK0) + b'#'
+    assert _frame([data[:5], data[5:20], data[20:]]) == [BLOCK0, BLOCK1,
+                                                          BLOCK0]
+
+
+def test_block_split_across_reads():
+    data = _wire(BLOCK1)
+    for cut in range(1, len(data)):
+        assert _frame([data[:cut], data[cut:] + b'#']) == [BLOCK1]
+
+
+def test_truncated_block_dropped():
+    data = _wire(BLOCK0)[:6] + _wire(BLOCK1) + b'#'
+    assert _frame([data]) == [BLOCK1]